@@ -5,9 +5,8 @@
 #######################################################################################
 
 # region Python imports
-import re
-
-import indigo
+import logging
+import time
 
 from RPFramework.RPFrameworkTelnetDevice import RPFrameworkTelnetDevice
 from RPFramework.RPFrameworkNonCommChildDevice import RPFrameworkNonCommChildDevice
@@ -19,6 +18,23 @@ from RPFramework.RPFrameworkCommand import RPFrameworkCommand
 
 CMD_CREATEZONESTATUSUPDATECOMMAND = "createZoneStatusUpdateCommands"
 CMD_ACTIVATEZONEFORCOMMAND        = "activateZoneForCommand"
+CMD_CREATEALLZONESSTATUSCOMMANDS  = "createAllZonesStatusRequestCommands"
+CMD_CREATEALLZONESMUTECOMMANDS    = "createAllZonesMuteCommands"
+
+# the (up to six) sources defined on the receiver as the source number reported by the
+# receiver, the property name of its label and the prefix of its menu option text
+SOURCE_LABEL_PROPS = tuple((f"{x}", f"source{x}Label", f"Source {x}: ") for x in range(1, 7))
+
+# pre-encoded activate zone writes for each of the zones supported by the receiver(s)
+ZONE_ACTIVATE_WRITES = {f"{x}": f"znc,4,{x}\r".encode("ascii") for x in range(1, 19)}
+
+# seconds after which a zone status request without a response is no longer considered
+# pending, allowing the next poll to request it again
+ZONE_UPDATE_PENDING_TIMEOUT = 10.0
+
+# payload of the all-zones status request queued by the periodic status poller; only the
+# poller may skip zones with an outstanding request (see RPFrameworkConfig.xml)
+ZONE_STATUS_POLL_PAYLOAD = "poll"
 
 # endregion
 #######################################################################################
@@ -36,6 +52,19 @@ class NilesAudioReceiverDevice(RPFrameworkTelnetDevice):
 	def __init__(self, plugin, device):
 		super().__init__(plugin, device, connection_type=RPFrameworkTelnetDevice.CONNECTIONTYPE_SERIAL)
 		self.active_control_zone = 0
+		self.last_zone_status    = {}
+		self.pending_zone_status = {}
+		self.source_labels       = {}
+		self.source_options      = []
+		self.refresh_source_labels(device)
+		
+		# the custom commands handled by this device, dispatched by command name
+		self.unmanaged_command_handlers = {
+			CMD_CREATEZONESTATUSUPDATECOMMAND: self.process_zone_status_update_command,
+			CMD_CREATEALLZONESSTATUSCOMMANDS : self.process_all_zones_status_request_command,
+			CMD_ACTIVATEZONEFORCOMMAND       : self.process_activate_zone_command,
+			CMD_CREATEALLZONESMUTECOMMANDS   : self.process_all_zones_mute_command
+		}
 
 	# endregion
 	#######################################################################################
@@ -47,47 +76,96 @@ class NilesAudioReceiverDevice(RPFrameworkTelnetDevice):
 	# base class; it will be called on a concurrent thread
 	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 	def handle_unmanaged_command_in_queue(self, ip_connection, rp_command):
-		if rp_command.command_name == CMD_CREATEZONESTATUSUPDATECOMMAND:
-			# create a set of commands to update the status of a single zone
-			update_command_list = [self.create_zone_activate_command(rp_command.command_payload), self.create_zone_status_request_command(rp_command.command_payload)]
-			self.queue_device_commands(update_command_list)
+		command_handler = self.unmanaged_command_handlers.get(rp_command.command_name, None)
+		if command_handler is not None:
+			command_handler(ip_connection, rp_command)
+
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	# This routine will create a set of commands to update the status of a single zone;
+	# these follow a write to the zone, so forget the last status frame to ensure the
+	# response is processed
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	def process_zone_status_update_command(self, ip_connection, rp_command):
+		self.last_zone_status.pop(rp_command.command_payload, None)
+		update_command_list = [self.create_zone_activate_command(rp_command.command_payload), self.create_zone_status_request_command(rp_command.command_payload)]
+		self.queue_device_commands(update_command_list)
+		self.pending_zone_status[rp_command.command_payload] = time.monotonic()
+
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	# This routine will create a set of commands to update the status of all zones defined
+	# by the plugin (as child devices); the status request only reports the active zone, so
+	# each zone must be activated ahead of its request. When queued by the periodic poller,
+	# zones which already have a status request queued are skipped as that response will be
+	# at least as recent as the one requested here; any other refresh (e.g. following all
+	# zones off) may sit behind a write, so requests every zone
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	def process_all_zones_status_request_command(self, ip_connection, rp_command):
+		poll_time = time.monotonic()
+		if rp_command.command_payload == ZONE_STATUS_POLL_PAYLOAD:
+			pending_zone_status = self.pending_zone_status
+			zones_to_update = [zone_number for zone_number in self.child_devices if zone_number not in pending_zone_status or poll_time - pending_zone_status[zone_number] > ZONE_UPDATE_PENDING_TIMEOUT]
+		else:
+			zones_to_update = list(self.child_devices)
 		
-		elif rp_command.command_name == "createAllZonesStatusRequestCommands":
-			# create a set of commands to update the status of all zones defined by the
-			# plugin (as child devices)
-			update_command_list = []
-			for zone_number in self.child_devices:
-				update_command_list.append(self.create_zone_activate_command(zone_number))
-				update_command_list.append(self.create_zone_status_request_command(zone_number))
-			
-			# queue up all the commands at once (so they will run back to back)
-			self.queue_device_commands(update_command_list)
+		create_activate_command = self.create_zone_activate_command
+		create_status_command   = self.create_zone_status_request_command
+		update_command_list = [command for zone_number in zones_to_update for command in (create_activate_command(zone_number), create_status_command(zone_number))]
+		
+		# queue up all the commands at once (so they will run back to back)
+		self.queue_device_commands(update_command_list)
+		for zone_number in zones_to_update:
+			self.pending_zone_status[zone_number] = poll_time
+
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	# This routine will immediately activate the requested zone (per the payload) for
+	# control if it is not already active
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	def process_activate_zone_command(self, ip_connection, rp_command):
+		if self.active_control_zone != int(rp_command.command_payload):
+			self.host_plugin.logger.threaddebug("Writing activate zone request for zone %s", rp_command.command_payload)
+			write_command = ZONE_ACTIVATE_WRITES.get(rp_command.command_payload)
+			if write_command is None:
+				write_command = b"znc,4,%s\r" % rp_command.command_payload.encode("ascii")
+			ip_connection.write(write_command)
+		else:
+			self.host_plugin.logger.threaddebug("Zone %s already active, ignoring activate zone command for efficiency", rp_command.command_payload)
 			
-		elif rp_command.command_name == CMD_ACTIVATEZONEFORCOMMAND:
-			# this command will immediately activate the requested zone (per the payload)
-			# for control if it is not already active
-			if self.active_control_zone != int(rp_command.command_payload):
-				self.host_plugin.logger.threaddebug(f"Writing activate zone request for zone {rp_command.command_payload}")
-				write_command = f"znc,4,{rp_command.command_payload}\r"
-				ip_connection.write(write_command.encode("ascii"))
-			else:
-				self.host_plugin.logger.threaddebug(f"Zone {rp_command.command_payload} already active, ignoring activate zone command for efficiency")
-				
-			# ensure that the delay is in place...
-			if rp_command.post_command_pause == 0.0:
-				rp_command.post_command_pause = 0.1
-				
-		elif rp_command.command_name == "createAllZonesMuteCommands":
-			# this command will be fired whenever the plugin needs to create the commands that will mute
-			# all zones (must be done individually)
-			mute_command_list = []
-			for zone_number in self.child_devices:
-				if self.child_devices[zone_number].indigoDevice.states["isPoweredOn"] and not self.child_devices[zone_number].indigoDevice.states["isMuted"]:
-					self.host_plugin.logger.threaddebug(f"Mute All: muting zone {zone_number}")
-					mute_command_list.append(RPFrameworkCommand(RPFrameworkTelnetDevice.CMD_WRITE_TO_DEVICE, command_payload=f"zsc,{zone_number},11", post_command_pause=0.1))
-					mute_command_list.append(RPFrameworkCommand(CMD_CREATEZONESTATUSUPDATECOMMAND, command_payload=str(zone_number), post_command_pause=0.1))
-			self.queue_device_commands(mute_command_list)
+		# ensure that the delay is in place...
+		if rp_command.post_command_pause == 0.0:
+			rp_command.post_command_pause = 0.1
+
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	# This routine will be fired whenever the plugin needs to create the commands that will
+	# mute all zones (must be done individually)
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	def process_all_zones_mute_command(self, ip_connection, rp_command):
+		mute_command_list = []
+		for zone_number, zone_device in self.child_devices.items():
+			zone_states = zone_device.indigoDevice.states
+			if zone_states["isPoweredOn"] and not zone_states["isMuted"]:
+				self.host_plugin.logger.threaddebug("Mute All: muting zone %s", zone_number)
+				mute_command_list.append(RPFrameworkCommand(RPFrameworkTelnetDevice.CMD_WRITE_TO_DEVICE, command_payload=f"zsc,{zone_number},11", post_command_pause=0.1))
+				mute_command_list.append(RPFrameworkCommand(CMD_CREATEZONESTATUSUPDATECOMMAND, command_payload=zone_number, post_command_pause=0.1))
+		self.queue_device_commands(mute_command_list)
 	
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	# This routine will read the source labels from the receiver's properties so that the
+	# zone status processing and source menus need not look them up each time; it must be
+	# called again whenever the properties may have been edited
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	def refresh_source_labels(self, device):
+		props          = device.pluginProps
+		source_labels  = {}
+		source_options = []
+		for source, source_prop_name, option_prefix in SOURCE_LABEL_PROPS:
+			source_label = props.get(source_prop_name, "")
+			source_labels[source] = source_label
+			if source_label != "":
+				source_options.append((source, option_prefix + source_label))
+		
+		self.source_labels  = source_labels
+		self.source_options = source_options
+
 	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 	# This routine will be called in order to generate the commands necessary to update
 	# the status of a zone defined for this receiver
@@ -97,7 +175,9 @@ class NilesAudioReceiverDevice(RPFrameworkTelnetDevice):
 			
 	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 	# This routine will be called in order to generate the commands necessary to activate
-	# a zone (for control) on this receiver
+	# a zone (for control) on this receiver; the command is always queued, even if the zone
+	# is active now, as its pause gives the receiver time to settle after a preceding write
+	# and the active zone may change (e.g. via an arbitrary command) before it runs
 	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 	def create_zone_activate_command(self, zone_number):
 		return RPFrameworkCommand(CMD_ACTIVATEZONEFORCOMMAND, command_payload=str(zone_number), post_command_pause=0.1)
@@ -114,64 +194,77 @@ class NilesAudioReceiverDevice(RPFrameworkTelnetDevice):
 	def zone_status_response_received(self, response_obj, rp_command):
 		# the response format is a comma-delimited list with the following values:
 		# USC, 2, [ZONE], [SOURCE #], [0|1 - ON/OFF], [VOLUME], [0|1 MUTE], [BASE], [TREB]
-		response_parser = re.compile(r'^usc,2,(?P<zone>\d+),(?P<source>\d+),(?P<onOff>0|1),(?P<volume>\d+),(?P<mute>0|1),(?P<base>\d+),(?P<treble>\d+)$', re.I)
-		status_obj = response_parser.match(response_obj)
-		status_info = status_obj.groupdict()
+		status_frame = response_obj.strip()
+		parts = status_frame.split(",")
+		# the receiver sends lowercase responses; only fold the case when that does not hold
+		if len(parts) != 9 or parts[1] != "2" or (parts[0] != "usc" and parts[0].lower() != "usc"):
+			self.host_plugin.logger.warning("Ignoring malformed zone status response: %r", response_obj)
+			return
+		zone = parts[2]
+		self.pending_zone_status.pop(zone, None)
 		
-		# device status updates are expensive, so only do the update on statuses that are
-		# different than current
-		self.host_plugin.logger.debug(f"Received status update for Zone {status_info['zone']}: {response_obj}")
-		zone_device = self.child_devices[status_info["zone"]]
-
-		# get the on/off status as this will determine what info we update; do not update it now
-		# since our uiValue may change depending upon other conditions
-		status_is_powered_on = status_info["onOff"] == "1"
-		force_ui_value_update = False
-		on_off_ui_value = ""
-
-		# we may only update the remainder of the states if the zone is powered on... otherwise
-		# the information is not reliable
-		if status_is_powered_on:
-			zone_states_to_update = []
+		zone_device = self.child_devices.get(zone, None)
+		if zone_device is None:
+			self.host_plugin.logger.threaddebug("Ignoring status update for zone %s as no device is defined for it", zone)
+			return
+		indigo_dev = zone_device.indigoDevice
 		
-			if zone_device.indigoDevice.states.get("source", "") != status_info["source"]:
-				ui_source_value = self.indigoDevice.pluginProps.get(f"source {status_info['source']} Label", "")
-				if ui_source_value == "":
-					ui_source_value = status_info["source"]
-				zone_states_to_update.append({"key": "source", "value": int(status_info["source"]), "uiValue": ui_source_value})
+		# the receiver reports the same frame on every poll while nothing changes, so there is
+		# no need to look at the states when it matches the last one processed for the zone's
+		# device; the device id is part of the key so a re-created (or re-numbered) zone device
+		# still receives the full status
+		zone_status = (indigo_dev.id, status_frame)
+		if self.last_zone_status.get(zone) == zone_status:
+			return
 		
-			status_volume = int(status_info["volume"])
-			if int(zone_device.indigoDevice.states.get("volume", "0")) != status_volume:
-				force_ui_value_update = True
-				zone_states_to_update.append({"key": "volume", "value": status_volume})
-			
-			if zone_device.indigoDevice.states.get("isMuted", False) != (status_info["mute"] == "1"):
-				force_ui_value_update = True
-				zone_states_to_update.append({"key": "isMuted", "value": (status_info["mute"] == "1")})
-			
-			status_base_level = int(status_info["base"])
-			if int(zone_device.indigoDevice.states.get("baseLevel", "0")) != status_base_level:
-				zone_states_to_update.append({"key": "baseLevel", "value": status_base_level})
-			
-			status_treble_level = int(status_info["treble"])
-			if int(zone_device.indigoDevice.states.get("trebleLevel", "0")) != status_treble_level:
-				zone_states_to_update.append({"key": "trebleLevel", "value": status_treble_level})
-				
-			# determine the on/off display text
-			if status_info["mute"] == "1" or status_volume == 0:
-				on_off_ui_value = "muted"
-			else:
-				on_off_ui_value = str(status_volume)
-				
-			if len(zone_states_to_update) > 0:
-				zone_device.indigoDevice.updateStatesOnServer(zone_states_to_update)
+		# device status updates are expensive, so only do the update on statuses that are
+		# different than current
+		if self.host_plugin.logger.isEnabledFor(logging.DEBUG):
+			self.host_plugin.logger.debug(f"Received status update for Zone {zone}: {response_obj}")
+		state_value = indigo_dev.states.get
+
+		# the remainder of the states are not reliable when the zone is powered off, so the
+		# only possible change is to the power state itself
+		if parts[4] != "1":
+			if state_value("isPoweredOn", False):
+				indigo_dev.updateStateOnServer(key="isPoweredOn", value=False, uiValue="off")
+			self.last_zone_status[zone] = zone_status
+			return
+
+		source, volume, mute, base, treble = parts[3], parts[5], parts[6], parts[7], parts[8]
+		status_source   = int(source)
+		status_volume   = int(volume)
+		status_is_muted = mute == "1"
+
+		# gather the new and current value of each state in one pass; only those which differ
+		# need to be sent to the server
+		zone_states = (
+			("source",      status_source,   state_value("source", 0)),
+			("volume",      status_volume,   state_value("volume", 0)),
+			("isMuted",     status_is_muted, state_value("isMuted", False)),
+			("bassLevel",   int(base),       state_value("bassLevel", 0)),
+			("trebleLevel", int(treble),     state_value("trebleLevel", 0))
+		)
+		zone_states_to_update = [{"key": key, "value": value} for key, value, current_value in zone_states if value != current_value]
+
+		# a source change (always first in the list when present) displays the source label
+		if status_source != zone_states[0][2]:
+			zone_states_to_update[0]["uiValue"] = self.source_labels.get(source, "") or source
+
+		# determine the on/off display text
+		if status_is_muted or status_volume == 0:
+			on_off_ui_value = "muted"
 		else:
-			on_off_ui_value = "off"
-			self.host_plugin.logger.debug("Skipping status update for zone that is off")
+			on_off_ui_value = str(status_volume)
 			
-		# finally update the on/off state...
-		if zone_device.indigoDevice.states.get("isPoweredOn", False) != status_is_powered_on or force_ui_value_update:
-			zone_device.indigoDevice.updateStateOnServer(key="isPoweredOn", value=status_is_powered_on, uiValue=on_off_ui_value)
+		# finally fold in the on/off state so that the whole frame is a single server update; its
+		# display text reflects the volume and mute status, so compare that as well
+		if not state_value("isPoweredOn", False) or state_value("isPoweredOn.ui", "") != on_off_ui_value:
+			zone_states_to_update.append({"key": "isPoweredOn", "value": True, "uiValue": on_off_ui_value})
+		
+		if len(zone_states_to_update) > 0:
+			indigo_dev.updateStatesOnServer(zone_states_to_update)
+		self.last_zone_status[zone] = zone_status
 			
 	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 	# This callback is made whenever the plugin has received the response to a request
@@ -179,10 +272,12 @@ class NilesAudioReceiverDevice(RPFrameworkTelnetDevice):
 	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 	def active_control_zone_updated(self, response_obj, rp_command):
 		# the response format is a comma-delimited response: rznc,4,[zone]
-		response_parser = re.compile(r'^rznc,4,(\d+)\s*$', re.I)
-		match_obj = response_parser.match(response_obj)
-		self.active_control_zone = int(match_obj.group(1))
-		self.host_plugin.logger.threaddebug(f"Updated active control zone to {match_obj.group(1)}")
+		parts = response_obj.strip().split(",")
+		if len(parts) != 3 or parts[1] != "4" or (parts[0] != "rznc" and parts[0].lower() != "rznc"):
+			self.host_plugin.logger.warning("Ignoring malformed active zone response: %r", response_obj)
+			return
+		self.active_control_zone = int(parts[2])
+		self.host_plugin.logger.threaddebug("Updated active control zone to %s", parts[2])
 
 	# endregion
 	#######################################################################################
@@ -211,16 +306,9 @@ class NilesAudioZone(RPFrameworkNonCommChildDevice):
 	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 	def getConfigDialogMenuItems(self, filter, valuesDict, typeId, targetId):
 		# we need the parent (receiver) device in order to get the list of
-		# available sources...
+		# available sources... it keeps them up to date with its properties
 		parent_receiver = self.host_plugin.managed_devices[int(self.indigoDevice.pluginProps["sourceReceiver"])]
-		
-		source_options = []
-		for x in range(1, 7):
-			source_prop_name = f"source{x}Label"
-			if parent_receiver.indigoDevice.pluginProps[source_prop_name] != "":
-				source_options.append((f"{x}", f"Source {x}: {parent_receiver.indigoDevice.pluginProps[source_prop_name]}"))
-			
-		return source_options
+		return parent_receiver.source_options
 
 	# endregion
 	#######################################################################################
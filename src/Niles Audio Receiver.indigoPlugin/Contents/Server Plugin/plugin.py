@@ -15,6 +15,17 @@ import nilesAudioDevices
 from RPFramework.RPFrameworkPlugin import RPFrameworkPlugin
 # endregion
 
+#######################################################################################
+# region Constants and configuration variables
+
+# validation errors (field id and message) returned by the arbitrary command menu; the
+# errors dictionary itself is created only when validation fails, as Indigo owns it
+NO_TARGET_DEVICE_ERROR = ("targetDevice", "Please select a device")
+NO_COMMAND_ERROR       = ("commandToSend", "Enter command to send")
+
+# endregion
+#######################################################################################
+
 
 class Plugin(RPFrameworkPlugin):
 	
@@ -31,6 +42,21 @@ class Plugin(RPFrameworkPlugin):
 	# endregion
 	#######################################################################################
 
+	#######################################################################################
+	# region Indigo control methods
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	# This routine is called by Indigo whenever one of the plugin's devices is updated; the
+	# receiver caches its source labels, so those must be refreshed as the properties may
+	# have been edited
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	def deviceUpdated(self, origDev, newDev):
+		super().deviceUpdated(origDev, newDev)
+		if newDev.deviceTypeId == "nilesAudioReceiver" and newDev.id in self.managed_devices:
+			self.managed_devices[newDev.id].refresh_source_labels(newDev)
+
+	# endregion
+	#######################################################################################
+
 	#######################################################################################
 	# region Actions object callback handlers/routines
 	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
@@ -39,27 +65,42 @@ class Plugin(RPFrameworkPlugin):
 	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 	def send_arbitrary_command(self, valuesDict, typeId):
 		try:
-			device_id    = valuesDict.get("targetDevice", "0")
-			command_code = valuesDict.get("commandToSend", "").strip()
+			device_id = int(valuesDict.get("targetDevice") or 0)
+		except (TypeError, ValueError):
+			device_id = 0
+		command_code = valuesDict.get("commandToSend", "").strip()
+	
+		if device_id <= 0 or device_id not in self.managed_devices:
+			# no (valid) device was selected or the selected device is no longer managed by
+			# this plugin (e.g. a stale selection of a deleted receiver)
+			return False, valuesDict, self.create_validation_error(NO_TARGET_DEVICE_ERROR)
+		elif command_code == "":
+			return False, valuesDict, self.create_validation_error(NO_COMMAND_ERROR)
 		
-			if device_id == "" or device_id == "0":
-				# no device was selected
-				error_dict = indigo.Dict()
-				error_dict["targetDevice"] = "Please select a device"
-				return False, valuesDict, error_dict
-			elif command_code == "":
-				error_dict = indigo.Dict()
-				error_dict["commandToSend"] = "Enter command to send"
-				return False, valuesDict, error_dict
-			else:
-				# send the code using the normal action processing...
-				action_params = indigo.Dict()
-				action_params["commandCode"] = command_code
-				self.execute_action(pluginAction=None, indigoActionId="SendArbitraryCommand", indigoDeviceId=int(device_id), paramValues=action_params)
-				return True, valuesDict
-		except:
+		try:
+			# send the code using the normal action processing...
+			action_params = indigo.Dict()
+			action_params["commandCode"] = command_code
+			self.execute_action(pluginAction=None, indigoActionId="SendArbitraryCommand", indigoDeviceId=device_id, paramValues=action_params)
+			return True, valuesDict
+		except Exception:
 			self.logger.exception("Failed to send command to device")
 			return False, valuesDict
 
 	# endregion
 	#######################################################################################
+
+	#######################################################################################
+	# region Utility routines
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	# This routine will create the errors dictionary returned to Indigo for a failed
+	# validation from a (field id, message) error definition
+	# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+	def create_validation_error(self, error):
+		field_id, message = error
+		error_dict = indigo.Dict()
+		error_dict[field_id] = message
+		return error_dict
+
+	# endregion
+	#######################################################################################